@@ -9,16 +9,29 @@ import pandas as pd
 
 # Read in the trajectory data
 user000 = pd.read_csv('../example_data/data_000_track.csv')
-user179 = pd.read_csv('../example_data/data_179_track.csv')
-print(f"User 000: (Rows: {user000.shape[0]}) | User 010: (Rows: {user179.shape[0]})")
+user010 = pd.read_csv('../example_data/data_010_track.csv')
+print(f"User 000: (Rows: {user000.shape[0]}) | User 010: (Rows: {user010.shape[0]})")
 
-# Build the spatial index on the larger of the two data sets
-user179_points = list(zip(user179.longitude, user179.latitude))
-user179_sindex = NearestNeighbor(user179_points).build_index()
+# Build the spatial index on the larger of the two data sets, straight from
+# its coordinate columns. The DataFrame index is used as the row id of each
+# point, and the timestamp column is carried along as a payload.
+user010_sindex = NearestNeighbor.from_frame(
+    user010,
+    x='longitude',
+    y='latitude',
+    payload=['datetime'],
+).build_index()
 
-# For each point in user000, find the nearest point in user010
-user000['points'] = list(zip(user000.longitude, user000.latitude))
-# user179_nn column contains the point in user179 closest to the provided point
-# In each row from user000
-user000['user179_nn'] = user000.points.apply(lambda x: user179_sindex.search_index(x))
+# For each point in user000, find the nearest point in user010. query_frame
+# returns the row id, coordinates, distance and payload of each nearest
+# neighbor as typed columns sharing the user000 index, ready to be joined.
+user010_nn = user010_sindex.query_frame(user000, x='longitude', y='latitude')
+user000 = user000.join(user010_nn)
 print(user000.head())
+
+# Single points can also be searched. output='index' returns the
+# (row id, distance) of the nearest neighbor, and output='payload' its
+# payload columns.
+row_id, distance = user010_sindex.search_index((116.3216, 40.008816), output='index')
+payload = user010_sindex.search_index((116.3216, 40.008816), output='payload')
+print(f"Nearest row: {row_id} | Distance: {distance:0.6f} | Payload: {payload}")
@@ -1,9 +1,22 @@
 import math
 import collections
-import operator
+import heapq
+import itertools
+import numpy as np
 from pydantic import BaseModel, ValidationError
 from typing import *
 
+# Default number of points stored in a k-d tree leaf bucket. Picked from
+# NearestNeighborTest.test_leaf_size_benchmark, which times the bbox search
+# across leaf sizes: on 10k random points, sizes 128-256 are the fastest,
+# about 1.5-2x faster than single-point leaves.
+DEFAULT_LEAF_SIZE = 128
+
+# Maximum number of query rows scanned against a leaf bucket at once by the
+# batched k-d tree search. Bounds the size of its (queries x points) distance
+# matrices.
+QUERY_BLOCK_SIZE = 4096
+
 class ValidPoint(BaseModel):
     """
     This is a Pydantic class to valid the input for data structures that require
@@ -21,66 +34,237 @@ class ValidPointsIterable(BaseModel):
 class KDBinaryTree(BaseModel):
     """
     This is a Pydantic class that ducments the base node data structure for
-    a binary k-d tree.
+    a binary k-d tree. 'indices' is the tuple of input positions whose point
+    equals 'value'; it holds more than one position only when duplicates are
+    collapsed, in which case len(indices) is the duplicate count. 'bbox' is the
+    (mins, maxs) bounding box of every point in the subtree rooted at the node.
+
+    Subtrees of at most leaf_size points are stored as a Leaf bucket instead:
+    'points' is a contiguous (n, k) float array scanned in a single vectorized
+    pass, and 'indices' holds the indices of each row of 'points' (an (n, 1)
+    position array unless duplicates are collapsed). 'positions' is the array
+    of the first input position of each row, used by batched searches.
+    """
+    BT = collections.namedtuple("BT", ["value", "indices", "bbox", "left", "right"])
+    Leaf = collections.namedtuple("Leaf", ["points", "indices", "positions", "bbox"])
+
+class VPTree(BaseModel):
     """
-    BT = collections.namedtuple("BT", ["value", "left", "right"])
+    This is a Pydantic class that documents the node data structure for a
+    vantage-point tree. 'value' is the vantage point and 'indices' the tuple of
+    input positions whose point equals it. 'radius' is the median metric
+    distance from the vantage point to the rest of its subtree: points within
+    the radius are stored under 'inside', the others under 'outside'.
+    """
+    VPNode = collections.namedtuple("VPNode", ["value", "indices", "radius",
+                                               "inside", "outside"])
 
 class NNClosestNeighbor(BaseModel):
     """
     This is a Pydantic class to document the data structure for the current
     closest point relative to a given query point in a NN search traversing
-    a k-d tree.
+    a spatial index. 'evaluations' counts the point distances computed by the
+    search.
     """
-    NNRecord = collections.namedtuple("NNRecord", ["point", "distance"])
+    NNRecord = collections.namedtuple("NNRecord", ["point", "indices", "distance",
+                                                   "evaluations"])
 
 class SpatialUtils:
     """
     This class contains several static methods that are spatial utilities.
     """
     @staticmethod
-    def _build_kdtree(points: ValidPointsIterable) -> KDBinaryTree:
+    def _build_kdtree(columns: Sequence[np.ndarray],
+                        collapse_duplicates: bool = False,
+                        leaf_size: int = 1) -> KDBinaryTree:
         """
         This method defines the binary tree data structure and recursively
         calls the 'build' method to construct a k-d tree spatial index on the
         provided set of points.
 
+        The points are given as one coordinate array per axis, e.g. the x and
+        y columns of a DataFrame, and are only accessed through NumPy fancy
+        indexing: the build never materializes a Python tuple per input row.
+
+        Every node stores the position of its point in the input columns, so
+        that search results can be mapped back to the source row (and to any
+        parallel payload arrays) without a coordinate lookup.
+
+        When collapse_duplicates is set, exact duplicate points are stored as a
+        single node holding the positions of every copy. This keeps the tree
+        shallow for data with long stationary runs, such as GPS tracks.
+
+        Each node also stores the bounding box of its subtree, which the
+        best-first search uses to prune whole subtrees by their exact distance
+        to the query point.
+
+        With a leaf_size above 1, the recursion stops at subsets of at most
+        leaf_size points, which are stored as Leaf buckets in contiguous
+        arrays. Searching a bucket is one vectorized scan instead of several
+        levels of Python-level branching.
+
         Note: Algorithm adapted from https://en.wikipedia.org/wiki/K-d_tree
 
-        :param points: Iterable of points as defined by the ValidPointsIterable
-        class.
+        :param columns: Sequence of k float arrays of equal length, holding
+        the coordinates of the points along each axis.
+        :param collapse_duplicates: Boolean to store exact duplicate points in
+        a single node.
+        :param leaf_size: Maximum number of points in a Leaf bucket. 1 builds a
+        tree of single-point nodes only.
         :returns: K-dimensional binary tree as defined by the KDBinaryTree
         class.
+        :raises ValueError: Coordinates must be finite
         """
 
-        k = len(points[0])
-        BT = collections.namedtuple("BT", ["value", "left", "right"])
+        k = len(columns)
+        # Node types are shared with the searches, which tell leaves apart
+        BT, Leaf = KDBinaryTree.BT, KDBinaryTree.Leaf
 
-        def _build(points: ValidPointsIterable, depth: int):
+        # NaN distances never compare as closer, so a NaN point would hide
+        # every other point of its leaf bucket from the searches
+        for axis, column in enumerate(columns):
+            if not np.isfinite(column).all():
+                raise ValueError(f"Error: coordinates along axis {axis} must be "
+                                 f"finite, got NaN or infinity")
+
+        if collapse_duplicates:
+            # Index the first copy of each point; the others hang off it
+            entries = SpatialUtils._index_entries(
+                list(zip(*(column.tolist() for column in columns))),
+                collapse_duplicates=True)
+            duplicates = {indices[0]: indices for _, indices in entries}
+            positions = np.fromiter(duplicates, dtype=np.intp, count=len(duplicates))
+        else:
+            duplicates = None
+            positions = np.arange(len(columns[0]), dtype=np.intp)
+
+        def _build(positions: np.ndarray, depth: int):
             """
-            Recursively construct a k-dimensional tree from a given set of points.
+            Recursively construct a k-dimensional tree from a given array of
+            point positions.
             """
-            if len(points) == 0:
+            if len(positions) == 0:
                 return None
+            if leaf_size > 1 and len(positions) <= leaf_size:
+                bucket = np.column_stack([column[positions] for column in columns])
+                if duplicates is None:
+                    # One row of indices per point, without a tuple per row
+                    indices = positions[:, np.newaxis]
+                else:
+                    indices = [duplicates[position] for position in positions.tolist()]
+                return Leaf(
+                    points = bucket,
+                    indices = indices,
+                    positions = positions,
+                    bbox = (tuple(bucket.min(axis=0).tolist()),
+                            tuple(bucket.max(axis=0).tolist())),
+                )
 
             # Selects the axis based on current depth
-            points.sort(key=operator.itemgetter(depth % k))
+            axis = depth % k
+            positions = positions[np.argsort(columns[axis][positions], kind='stable')]
             # Grab the median point as the current pivot node
-            middle = len(points) // 2
+            middle = len(positions) // 2
+            pivot = int(positions[middle])
+            value = tuple(float(column[pivot]) for column in columns)
+            left = _build(
+                positions=positions[:middle],
+                depth=depth+1,
+            )
+            right = _build(
+                positions=positions[middle+1:],
+                depth=depth+1,
+            )
+            # The subtree bounding box is the union of the pivot point and
+            # the bounding boxes of both children
+            children = [child.bbox for child in (left, right) if child is not None]
+            bbox = (
+                tuple(map(min, zip(value, *(mins for mins, _ in children)))),
+                tuple(map(max, zip(value, *(maxs for _, maxs in children)))),
+            )
             BTNode = BT(
-                value = points[middle],
-                left = _build(
-                    points=points[:middle],
-                    depth=depth+1,
-                ),
-                right = _build(
-                    points=points[middle+1:],
-                    depth=depth+1,
-                ),
+                value = value,
+                indices = (pivot,) if duplicates is None else duplicates[pivot],
+                bbox = bbox,
+                left = left,
+                right = right,
             )
             return BTNode
 
         # Recursively build the k-d tree starting at root level
-        tree = _build(points=list(points), depth=0)
+        tree = _build(positions=positions, depth=0)
+        return tree
+
+    @staticmethod
+    def _index_entries(points: ValidPointsIterable,
+                       collapse_duplicates: bool) -> List[Tuple[ValidPoint, Tuple[int, ...]]]:
+        """
+        PRIVATE - Pair every point with the tuple of its input positions, the
+        entries from which the spatial indexes are built.
+
+        :param collapse_duplicates: Boolean to merge exact duplicate points
+        into a single entry holding the positions of every copy.
+        :returns: List of (point, indices) tuples.
+        """
+        if not collapse_duplicates:
+            return [(point, (position,)) for position, point in enumerate(points)]
+        # Group the positions of identical points, keeping input order
+        groups = {}
+        for position, point in enumerate(points):
+            groups.setdefault(point, []).append(position)
+        return [(point, tuple(positions)) for point, positions in groups.items()]
+
+    @staticmethod
+    def _build_vptree(points: ValidPointsIterable,
+                      metric: Callable[[ValidPoint, ValidPoint], float],
+                      collapse_duplicates: bool = False) -> VPTree:
+        """
+        This method constructs a vantage-point tree spatial index on the
+        provided set of points for an arbitrary distance metric.
+
+        Each node picks a vantage point and splits the rest of its points at
+        the median metric distance to it. Unlike the k-d tree, the structure
+        and its pruning rely only on metric distances, so any metric satisfying
+        the triangle inequality can be indexed.
+
+        Note: Algorithm adapted from https://en.wikipedia.org/wiki/Vantage-point_tree
+
+        :param points: Iterable of points as defined by the ValidPointsIterable
+        class.
+        :param metric: Function returning the distance between two points.
+        :param collapse_duplicates: Boolean to store exact duplicate points in
+        a single node.
+        :returns: Vantage-point tree as defined by the VPTree class.
+        """
+        VPNode = VPTree.VPNode
+
+        def _build(entries: List[Tuple[ValidPoint, Tuple[int, ...]]]):
+            """
+            Recursively construct a vantage-point tree from a given list of
+            (point, indices) entries, using the first entry as vantage point.
+            """
+            if len(entries) == 0:
+                return None
+
+            (value, indices), rest = entries[0], entries[1:]
+            # Sort the remaining entries by their distance to the vantage point
+            distances = [metric(value, point) for point, _ in rest]
+            order = sorted(range(len(rest)), key=distances.__getitem__)
+            # The median distance splits the inside and outside subtrees
+            middle = len(rest) // 2
+            radius = distances[order[middle]] if rest else 0.0
+            VPTreeNode = VPNode(
+                value = value,
+                indices = indices,
+                radius = radius,
+                inside = _build([rest[i] for i in order[:middle]]),
+                outside = _build([rest[i] for i in order[middle:]]),
+            )
+            return VPTreeNode
+
+        entries = SpatialUtils._index_entries(points, collapse_duplicates)
+        # Recursively build the vp-tree starting at root level
+        tree = _build(entries=entries)
         return tree
 
     @staticmethod
@@ -88,24 +272,40 @@ class SpatialUtils:
                                         point: ValidPoint) -> ValidPoint:
         """
         PRIVATE - Find the nearest neighbor in a k-d tree for a given point.
+
+        :returns: NNRecord holding the nearest point, its indices, the squared
+        distance to the query point and the number of distance evaluations.
         """
         k = len(point)
-        NNRecord = collections.namedtuple("NNRecord", ["point", "distance"])
+        # The record type is shared, creating a namedtuple per query is costly
+        NNRecord = NNClosestNeighbor.NNRecord
 
         best = None
+        evaluations = 0
         def _search(tree: KDBinaryTree, depth: int):
             """Recursively search through the k-d tree to find the
             nearest neighbor.
             """
             # Need to access 'best' out of _search scope
-            nonlocal best
+            nonlocal best, evaluations
 
             if tree is None:
                return None
 
+            if isinstance(tree, KDBinaryTree.Leaf):
+                position, distance = SpatialUtils._scan_bucket(tree.points, point)
+                evaluations += len(tree.points)
+                if best is None or distance < best.distance:
+                    best = NNRecord(point=tuple(tree.points[position].tolist()),
+                                    indices=tree.indices[position],
+                                    distance=distance, evaluations=None)
+                return None
+
             distance = SpatialUtils.calculate_distance(tree.value, point)
+            evaluations += 1
             if best is None or distance < best.distance:
-                best = NNRecord(point=tree.value, distance=distance)
+                best = NNRecord(point=tree.value, indices=tree.indices,
+                                distance=distance, evaluations=None)
 
             axis = depth % k
             diff = point[axis] - tree.value[axis]
@@ -120,7 +320,237 @@ class SpatialUtils:
 
         # Recursively search the tree starting at root level
         _search(tree=tree, depth=0)
-        return best.point
+        return best._replace(evaluations=evaluations)
+
+    @staticmethod
+    def _find_nearest_neighbor_kdtree_bbox(tree: KDBinaryTree,
+                                           point: ValidPoint) -> ValidPoint:
+        """
+        PRIVATE - Find the nearest neighbor in a k-d tree for a given point,
+        using an iterative best-first traversal.
+
+        Subtrees are visited from a priority queue ordered by the exact
+        squared distance between the query point and their bounding box. Once
+        the closest remaining box is no closer than the current best point,
+        no other subtree can hold a closer point and the search stops. This
+        prunes tighter than the split-plane test of the recursive search,
+        notably on clustered data, and has no recursion depth limit.
+
+        :returns: NNRecord holding the nearest point, its indices, the squared
+        distance to the query point and the number of distance evaluations.
+        """
+        # The record type is shared, creating a namedtuple per query is costly
+        NNRecord = NNClosestNeighbor.NNRecord
+
+        def _box_distance(bbox) -> float:
+            """Squared distance from the query point to a bounding box."""
+            total = 0.0
+            for q, lo, hi in zip(point, bbox[0], bbox[1]):
+                if q < lo:
+                    total += (lo - q) ** 2
+                elif q > hi:
+                    total += (q - hi) ** 2
+            return total
+
+        best_point = None
+        best_indices = None
+        best_distance = math.inf
+        evaluations = 0
+        # The counter breaks box distance ties without comparing nodes
+        counter = itertools.count()
+        queue = [(0.0, next(counter), tree)] if tree is not None else []
+        while queue:
+            box_distance, _, node = heapq.heappop(queue)
+            if box_distance >= best_distance:
+                break
+            if isinstance(node, KDBinaryTree.Leaf):
+                position, distance = SpatialUtils._scan_bucket(node.points, point)
+                evaluations += len(node.points)
+                if distance < best_distance:
+                    best_point = tuple(node.points[position].tolist())
+                    best_indices = node.indices[position]
+                    best_distance = distance
+                continue
+            distance = sum((i - j) ** 2 for i, j in zip(node.value, point))
+            evaluations += 1
+            if distance < best_distance:
+                best_point, best_indices = node.value, node.indices
+                best_distance = distance
+            for child in (node.left, node.right):
+                if child is not None:
+                    child_distance = _box_distance(child.bbox)
+                    if child_distance < best_distance:
+                        heapq.heappush(queue, (child_distance, next(counter), child))
+
+        return NNRecord(point=best_point, indices=best_indices,
+                        distance=float(best_distance), evaluations=evaluations)
+
+    @staticmethod
+    def _find_nearest_neighbors_kdtree_batch(tree: KDBinaryTree, queries: np.ndarray
+                                             ) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        PRIVATE - Find the nearest neighbor in a k-d tree for a block of query
+        points at once.
+
+        The tree is traversed once for the whole block, with an explicit stack
+        of (node, query positions) pairs. At every node, the queries whose
+        current best is no farther than the node bounding box are dropped, the
+        rest are compared to the node point in one vectorized pass, and are
+        split by the side of the splitting plane they fall on so that each
+        group visits its closer child first. Leaf buckets are scanned with
+        (queries x points) distance matrices of at most QUERY_BLOCK_SIZE
+        queries. No Python object is created per query point.
+
+        :param tree: K-dimensional binary tree as defined by the KDBinaryTree
+        class.
+        :param queries: (m, k) float array of query points.
+        :returns: The input position of the nearest point of each query, its
+        squared distance, and the number of distance evaluations.
+        """
+        k = queries.shape[1]
+        best_positions = np.zeros(len(queries), dtype=np.intp)
+        best_distances = np.full(len(queries), np.inf)
+        evaluations = 0
+
+        block = np.arange(len(queries), dtype=np.intp)
+        stack = [(tree, block, 0)] if tree is not None and len(block) else []
+        while stack:
+            node, block, depth = stack.pop()
+            # Drop the queries that cannot find a closer point in this subtree
+            block_queries = queries[block]
+            gaps = (np.maximum(np.subtract(node.bbox[0], block_queries), 0.0)
+                    + np.maximum(np.subtract(block_queries, node.bbox[1]), 0.0))
+            keep = (gaps * gaps).sum(axis=1) < best_distances[block]
+            block, block_queries = block[keep], block_queries[keep]
+            if len(block) == 0:
+                continue
+
+            if isinstance(node, KDBinaryTree.Leaf):
+                for start in range(0, len(block), QUERY_BLOCK_SIZE):
+                    chunk = block[start:start + QUERY_BLOCK_SIZE]
+                    deltas = (block_queries[start:start + QUERY_BLOCK_SIZE, np.newaxis, :]
+                              - node.points[np.newaxis, :, :])
+                    distances = (deltas * deltas).sum(axis=2)
+                    evaluations += distances.size
+                    rows = distances.argmin(axis=1)
+                    distances = distances[np.arange(len(chunk)), rows]
+                    closer = distances < best_distances[chunk]
+                    best_distances[chunk[closer]] = distances[closer]
+                    best_positions[chunk[closer]] = node.positions[rows[closer]]
+                continue
+
+            deltas = block_queries - node.value
+            distances = (deltas * deltas).sum(axis=1)
+            evaluations += len(block)
+            closer = distances < best_distances[block]
+            best_distances[block[closer]] = distances[closer]
+            best_positions[block[closer]] = node.indices[0]
+
+            axis = depth % k
+            left_first = block_queries[:, axis] <= node.value[axis]
+            # The stack is last in, first out: push the far visits first
+            visits = (
+                (node.right, block[left_first]),
+                (node.left, block[~left_first]),
+                (node.left, block[left_first]),
+                (node.right, block[~left_first]),
+            )
+            for child, child_block in visits:
+                if child is not None and len(child_block):
+                    stack.append((child, child_block, depth + 1))
+
+        return best_positions, best_distances, evaluations
+
+    @staticmethod
+    def _find_nearest_neighbor_vptree(tree: VPTree, point: ValidPoint,
+                                      metric: Callable[[ValidPoint, ValidPoint], float]
+                                      ) -> ValidPoint:
+        """
+        PRIVATE - Find the nearest neighbor in a vantage-point tree for a
+        given point, using an iterative traversal.
+
+        By the triangle inequality, the points inside a node are at least
+        distance - radius away from the query point, and the points outside
+        at least radius - distance away, where distance is the metric distance
+        from the query point to the vantage point. Subtrees whose lower bound
+        is no closer than the current best are skipped, so the search only
+        calls the metric, once per visited node.
+
+        :returns: NNRecord holding the nearest point, its indices, the metric
+        distance to the query point and the number of distance evaluations.
+        """
+        # The record type is shared, creating a namedtuple per query is costly
+        NNRecord = NNClosestNeighbor.NNRecord
+
+        best = None
+        best_distance = math.inf
+        evaluations = 0
+        # Explicit stack of (subtree, lower bound on its distance) pairs
+        stack = [(tree, 0.0)] if tree is not None else []
+        while stack:
+            node, bound = stack.pop()
+            if bound >= best_distance:
+                continue
+            distance = metric(point, node.value)
+            evaluations += 1
+            if distance < best_distance:
+                best, best_distance = node, distance
+            inside = (node.inside, max(distance - node.radius, 0.0))
+            outside = (node.outside, max(node.radius - distance, 0.0))
+            # Push the likelier subtree last so that it is searched first
+            for child, child_bound in ((outside, inside) if distance <= node.radius
+                                       else (inside, outside)):
+                if child is not None and child_bound < best_distance:
+                    stack.append((child, child_bound))
+
+        return NNRecord(point=best.value, indices=best.indices,
+                        distance=float(best_distance), evaluations=evaluations)
+
+    @staticmethod
+    def _scan_bucket(points: np.ndarray, point: ValidPoint) -> Tuple[int, float]:
+        """
+        PRIVATE - Brute force search of a leaf bucket, vectorized over its
+        contiguous (n, k) points array.
+
+        :returns: The row of the closest point in points and its squared
+        distance to point.
+        """
+        deltas = points - point
+        distances = (deltas * deltas).sum(axis=1)
+        position = int(distances.argmin())
+        return position, float(distances[position])
+
+    @staticmethod
+    def tree_stats(tree: KDBinaryTree) -> Dict[str, int]:
+        """
+        This method summarizes the shape of a k-d tree or vantage-point tree.
+
+        :param tree: K-dimensional binary tree as defined by the KDBinaryTree
+        class, or vantage-point tree as defined by the VPTree class.
+        :returns: Dict with the number of nodes (leaf buckets included), the
+        number of leaf buckets, the number of indexed points (duplicates
+        included) and the depth of the tree.
+        """
+        stats = {'nodes': 0, 'leaves': 0, 'points': 0, 'depth': 0}
+        # Walk the tree with an explicit stack of (node, depth) pairs
+        stack = [(tree, 1)] if tree is not None else []
+        while stack:
+            node, depth = stack.pop()
+            stats['nodes'] += 1
+            stats['depth'] = max(stats['depth'], depth)
+            if isinstance(node, KDBinaryTree.Leaf):
+                stats['leaves'] += 1
+                stats['points'] += sum(len(indices) for indices in node.indices)
+                continue
+            stats['points'] += len(node.indices)
+            if isinstance(node, VPTree.VPNode):
+                children = (node.inside, node.outside)
+            else:
+                children = (node.left, node.right)
+            for child in children:
+                if child is not None:
+                    stack.append((child, depth + 1))
+        return stats
 
     @staticmethod
     def find_nearest_naive(query_point: ValidPoint,
@@ -155,6 +585,18 @@ class SpatialUtils:
                     min_point = point
         return min_point
 
+    @staticmethod
+    def euclidean_distance(point1: ValidPoint, point2: ValidPoint) -> float:
+        """
+        This method calculates the Euclidean distance between two points. It
+        is the default metric of the vantage-point tree index.
+
+        :param point1: The first point in a distance calculation.
+        :param point2: The second point in a distance calculation.
+        :returns: Returns the distance between point1 and point2 as a float.
+        """
+        return math.sqrt(sum((i - j) ** 2 for i, j in zip(point1, point2)))
+
     @staticmethod
     def calculate_distance(point1: ValidPoint, point2: ValidPoint) -> float:
         """
@@ -179,61 +621,373 @@ class NearestNeighbor:
     """
     This class constructs a NearestNeighbor object from which an iterable
     of points can be ingested, validated, and indexed using a kd-tree spatial
-    index for performant nearest neighbor queries.
+    index for performant nearest neighbor queries. A vantage-point tree index
+    is also available for custom distance metrics.
+
+    Each point keeps a row id (its position in the input by default) and,
+    optionally, payload columns stored in arrays parallel to the points. The
+    spatial index refers to rows by position, so searches can return the row
+    id, the distance, or the payload of the nearest neighbor directly.
+
+    from_frame and query_frame build from and query with DataFrame columns
+    directly, returning a whole-frame nearest neighbor join as typed columns.
 
     Attributes:
-        points (ValidPointsIterable): the points that will be indexed.
+        points (ValidPointsIterable): the points that will be indexed, or None
+        when built with from_frame.
+        columns (tuple): one float array per axis holding the point
+        coordinates.
+        ids (np.ndarray): the row id of each point (the DataFrame index when
+        built with from_frame).
+        payload (dict): payload column name -> array of values, one per point.
     """
-    def __init__(self, points) -> None:
+    def __init__(self, points, ids: Optional[Iterable[Hashable]] = None,
+                 payload: Optional[Dict[str, Iterable[Any]]] = None) -> None:
         """
         Initializes the NearestNeighbor class. performs input type validation
         using the ValidPointsIterable Pydantic class.
 
         :param points: The iterable of ValidPoint objects
+        :param ids: Optional iterable of row ids, one per point (e.g. the
+        index of the DataFrame the points came from). Defaults to the position
+        of each point.
+        :param payload: Optional mapping of column name -> iterable of values,
+        one value per point, returned by searches with output='payload'.
         :returns: None
         :raises ValidationError: Input iterable must consist of [ValidPoint, ...]
+        :raises ValueError: ids and payload columns must match the points length
         """
         # Validate the points iterable input
         try:
             points = ValidPointsIterable(points=points)
-            self.points = points.points
+            points = points.points
         except ValidationError as e:
             print(e.json())
+        # The k-d tree is built from one coordinate array per axis
+        self._initialize(
+            points=points,
+            columns=tuple(np.array(points, dtype=float).reshape(-1, 2).T),
+            ids=ids,
+            payload=payload or {},
+        )
+
+    @classmethod
+    def from_frame(cls, frame: "pd.DataFrame", x: str, y: str,
+                   payload: Optional[Sequence[str]] = None) -> "NearestNeighbor":
+        """
+        Initializes the NearestNeighbor class from the columns of a DataFrame.
+
+        The x and y columns are used as NumPy views of the column buffers when
+        they are already float64, so no per-row tuples or copies are created.
+        The DataFrame index becomes the row ids, and the payload columns are
+        kept as arrays.
+
+        :param frame: The pandas DataFrame holding the points.
+        :param x: Name of the column holding the x coordinates.
+        :param y: Name of the column holding the y coordinates.
+        :param payload: Optional names of the columns returned by searches with
+        output='payload' and by query_frame.
+        :returns: NearestNeighbor object, ready for build_index.
+        :raises ValueError: The x and y columns must be numeric and finite
+        """
+        # Skip the point validation of __init__, the columns are checked here
+        nn = cls.__new__(cls)
+        nn._initialize(
+            points=None,
+            columns=cls._frame_columns(frame, x, y),
+            ids=frame.index,
+            payload={name: frame[name] for name in (payload or [])},
+        )
+        return nn
+
+    def _initialize(self, points: Optional[ValidPointsIterable],
+                    columns: Tuple[np.ndarray, ...],
+                    ids: Optional[Iterable[Hashable]],
+                    payload: Dict[str, Iterable[Any]]) -> None:
+        """
+        PRIVATE - Set every attribute of a NearestNeighbor object. Shared by
+        __init__ and from_frame, so both build objects with the same state.
+
+        :raises ValueError: ids and payload columns must match the points length
+        """
+        self.points = points
+        self.columns = columns
+        self._set_rows(ids=ids, payload=payload)
+
+    @staticmethod
+    def _frame_columns(frame: "pd.DataFrame", x: str, y: str) -> Tuple[np.ndarray, ...]:
+        """
+        PRIVATE - Read the x and y columns of a DataFrame as float arrays,
+        without copying float64 columns.
+
+        :raises ValueError: The x and y columns must be numeric and finite
+        """
+        columns = (np.asarray(frame[x], dtype=float), np.asarray(frame[y], dtype=float))
+        # Missing coordinates are common in GPS data and cannot be searched
+        for name, column in zip((x, y), columns):
+            missing = np.flatnonzero(~np.isfinite(column))
+            if len(missing):
+                raise ValueError(f"Error: column '{name}' has {len(missing)} NaN or "
+                                 f"infinite values, first at row {frame.index[missing[0]]!r}")
+        return columns
+
+    def _set_rows(self, ids: Optional[Iterable[Hashable]],
+                  payload: Dict[str, Iterable[Any]]) -> None:
+        """
+        PRIVATE - Store the row ids and payload columns parallel to the points,
+        as arrays that searches gather by position.
+
+        :raises ValueError: ids and payload columns must match the points length
+        """
+        n = len(self.columns[0])
+        self.ids = np.arange(n) if ids is None else self._as_column(ids)
+        if len(self.ids) != n:
+            raise ValueError("Error: ids must have one entry per point")
+        self.payload = {}
+        for name, values in payload.items():
+            values = self._as_column(values)
+            if len(values) != n:
+                raise ValueError(f"Error: payload column '{name}' must have "
+                                 f"one entry per point")
+            self.payload[name] = values
 
-    def build_index(self, method: str = "kdtree") -> None:
+    @staticmethod
+    def _as_column(values: Iterable[Any]) -> np.ndarray:
+        """
+        PRIVATE - Convert ids or payload values to a 1-D array.
+
+        Numeric values keep their dtype, and NumPy arrays or pandas columns
+        are not copied. Any other values, e.g. strings, timestamps or tuples,
+        are stored one per element in an object array, so that they keep
+        their type and are never broadcast into extra dimensions.
+        """
+        if not hasattr(values, '__len__'):
+            values = list(values)
+        try:
+            column = np.asarray(values)
+        except ValueError:
+            # Ragged nested values cannot form a regular array
+            column = None
+        if column is None or column.ndim != 1 or column.dtype.kind not in 'biufc':
+            column = np.empty(len(values), dtype=object)
+            for row, value in enumerate(values):
+                column[row] = value
+        return column
+
+    def build_index(self, method: str = "kdtree",
+                    collapse_duplicates: bool = False,
+                    leaf_size: int = DEFAULT_LEAF_SIZE,
+                    metric: Optional[Callable[[ValidPoint, ValidPoint], float]] = None
+                    ) -> None:
         """
         This method builds the spatial index on the NearestNeighbor points
-        attribute, using a kd-tree method.
+        attribute, using a kd-tree or vp-tree method.
 
         :param method: A string value declaring the spatial index method to be
-        used. Future extensions of this class may include more spatial indexing
-        methods.
+        used. 'kdtree' indexes planar Euclidean distances. 'vptree' indexes any
+        metric satisfying the triangle inequality, such as weighted or
+        road-network-approximating distances.
+        :param collapse_duplicates: Boolean to store exact duplicate points as
+        a single index node. Useful for GPS tracks with stationary runs;
+        searches can still return every duplicate with expand_duplicates.
+        :param leaf_size: Maximum number of points stored in a k-d tree leaf
+        bucket, searched with a vectorized scan. 1 disables leaf buckets. Only
+        used by the 'kdtree' method.
+        :param metric: Function returning the distance between two points, used
+        by the 'vptree' method. Defaults to SpatialUtils.euclidean_distance.
         :returns: self
         """
-        valid_methods = ['kdtree']
+        valid_methods = ['kdtree', 'vptree']
         # Input spatial index method must be available
         if method not in valid_methods:
             raise ValueError(f"Error: sidx_type must be in ({valid_methods})")
-        else:
-            self.sidx_method = method
-        if self.sidx_method == 'kdtree':
+        if method == 'kdtree' and leaf_size < 1:
+            raise ValueError("Error: leaf_size must be at least 1")
+        if metric is not None and method != 'vptree':
+            raise ValueError("Error: metric is only supported by the 'vptree' method")
+        # Build into locals, so that a failed build leaves the current index
+        # and its method untouched
+        if method == 'kdtree':
             # Build the kd-tree spatial index
-            self.sidx = SpatialUtils()._build_kdtree(self.points)
+            sidx = SpatialUtils()._build_kdtree(
+                self.columns, collapse_duplicates=collapse_duplicates,
+                leaf_size=leaf_size)
+        elif method == 'vptree':
+            # Build the vp-tree spatial index. Metrics are called on point
+            # tuples, so frame columns are zipped into points here.
+            points = self.points
+            if points is None:
+                points = list(zip(*(column.tolist() for column in self.columns)))
+            metric = metric or SpatialUtils.euclidean_distance
+            sidx = SpatialUtils()._build_vptree(
+                points, metric=metric,
+                collapse_duplicates=collapse_duplicates)
+            self.metric = metric
+        self.sidx_method = method
+        self.sidx = sidx
         return self
 
-    def search_index(self, query_point: ValidPoint) -> ValidPoint:
+    def index_stats(self) -> Dict[str, int]:
+        """
+        This method reports the shape of the spatial index created by
+        build_index, see SpatialUtils.tree_stats.
+
+        :returns: Dict with the node count, point count and depth of the index.
+        """
+        return SpatialUtils().tree_stats(self.sidx)
+
+    def search_index(self, query_point: ValidPoint, output: str = "point",
+                     expand_duplicates: bool = False,
+                     engine: str = "bbox") -> Any:
         """
         This method searches the spatial index created by build_index and
         returns the nearest neighbor in the index to the input query_point.
 
+        The output parameter selects what is returned for the nearest neighbor:
+
+        - 'point': the (x, y) tuple of the nearest point.
+        - 'index': a (row id, distance) tuple, where distance is the Euclidean
+          distance between query_point and the nearest point (the metric
+          distance for 'vptree' indexes).
+        - 'payload': a dict of payload column name -> value for the nearest
+          point.
+
+        With expand_duplicates, 'index' returns a (list of row ids, distance)
+        tuple and 'payload' a list of dicts, one entry per point sharing the
+        nearest coordinates. This is only meaningful for indexes built with
+        collapse_duplicates; otherwise the lists hold a single entry.
+
         :param query_point: ValidPoint object from which to find the NN in the index
+        :param output: A string value declaring the result type, see above.
+        :param expand_duplicates: Boolean to return every duplicate of the
+        nearest point instead of the first one.
+        :param engine: A string value declaring the search algorithm. 'bbox'
+        (default) runs an iterative best-first search pruned by the node
+        bounding boxes; 'recursive' runs the split-plane recursive search.
+        Only used by 'kdtree' indexes. The number of distance evaluations of
+        the search is stored in the last_distance_evaluations attribute.
+        :returns: The nearest neighbor in the requested output format.
+        :raises ValueError: query_point must have finite coordinates
         """
+        valid_outputs = ['point', 'index', 'payload']
+        if output not in valid_outputs:
+            raise ValueError(f"Error: output must be in ({valid_outputs})")
         # Validate the input point
         try:
             query_point = ValidPoint(point=query_point)
             query_point = query_point.point
         except ValidationError as e:
             print(e.json())
+        if not all(map(math.isfinite, query_point)):
+            raise ValueError(f"Error: query_point must be finite, got {query_point}")
         # Calculate the nearest neighbor in the spatial index to the input point
-        result = SpatialUtils()._find_nearest_neighbor_kdtree(self.sidx, query_point)
-        return result
+        result, distance = self._search(query_point, engine)
+        indices = np.asarray(result.indices if expand_duplicates else result.indices[:1])
+        indices = indices.reshape(-1)
+        if output == 'index':
+            ids = self.ids[indices].tolist()
+            return (ids, distance) if expand_duplicates else (ids[0], distance)
+        if output == 'payload':
+            columns = {name: values[indices].tolist()
+                       for name, values in self.payload.items()}
+            payloads = [{name: values[row] for name, values in columns.items()}
+                        for row in range(len(indices))]
+            return payloads if expand_duplicates else payloads[0]
+        return result.point
+
+    def query_frame(self, frame: "pd.DataFrame", x: str, y: str) -> "pd.DataFrame":
+        """
+        This method searches the spatial index created by build_index for the
+        nearest neighbor of every row of a DataFrame.
+
+        The query coordinates are read from the x and y columns as float
+        arrays. On 'kdtree' indexes, all rows traverse the tree together (see
+        SpatialUtils._find_nearest_neighbors_kdtree_batch), so the whole join
+        runs on arrays without creating a Python object per row. 'vptree'
+        indexes call their metric on point tuples, so they are searched one
+        row at a time. The number of distance evaluations of the whole join is
+        stored in the last_distance_evaluations attribute.
+
+        The returned DataFrame shares the index of frame, so it can be joined
+        onto it directly. Its columns are:
+
+        - 'neighbor_id': the row id of the nearest point.
+        - 'neighbor_x', 'neighbor_y': the coordinates of the nearest point.
+          These names are fixed: the indexed points may come from columns
+          named differently from the x and y columns of frame, or from a
+          plain iterable of points.
+        - 'neighbor_distance': the distance to the nearest point.
+        - 'neighbor_<name>': the value of every payload column.
+
+        :param frame: The pandas DataFrame holding the query points.
+        :param x: Name of the column holding the x coordinates.
+        :param y: Name of the column holding the y coordinates.
+        :returns: DataFrame with one nearest neighbor row per row of frame.
+        :raises ValueError: The x and y columns must be numeric and finite
+        :raises ValueError: Payload names must not clash with the other result
+        columns, e.g. a payload column named 'distance'
+        """
+        import pandas as pd
+
+        # Result column names must be unique, or one column would silently
+        # overwrite another
+        names = (['neighbor_id', 'neighbor_x', 'neighbor_y', 'neighbor_distance']
+                 + [f'neighbor_{name}' for name in self.payload])
+        clashes = sorted({name for name in names if names.count(name) > 1})
+        if clashes:
+            raise ValueError(f"Error: result columns {clashes} clash, rename the "
+                             f"payload columns")
+        xs, ys = self._frame_columns(frame, x, y)
+        if self.sidx_method == 'kdtree':
+            positions, distances, evaluations = (
+                SpatialUtils()._find_nearest_neighbors_kdtree_batch(
+                    self.sidx, np.column_stack((xs, ys))))
+            # The k-d tree searches work on squared distances
+            distances = np.sqrt(distances)
+        else:
+            positions = np.empty(len(frame), dtype=np.intp)
+            distances = np.empty(len(frame), dtype=float)
+            evaluations = 0
+            for row, query_point in enumerate(zip(xs.tolist(), ys.tolist())):
+                result, distances[row] = self._search(query_point, 'bbox')
+                positions[row] = result.indices[0]
+                evaluations += result.evaluations
+        self.last_distance_evaluations = evaluations
+
+        # Gather the neighbor columns with one vectorized take each
+        columns = {
+            'neighbor_id': self.ids[positions],
+            'neighbor_x': self.columns[0][positions],
+            'neighbor_y': self.columns[1][positions],
+            'neighbor_distance': distances,
+        }
+        for name, values in self.payload.items():
+            columns[f'neighbor_{name}'] = values[positions]
+        return pd.DataFrame(columns, index=frame.index)
+
+    def _search(self, query_point: ValidPoint, engine: str) -> Tuple[Any, float]:
+        """
+        PRIVATE - Run the nearest neighbor search of the index method on a
+        validated query point.
+
+        :returns: The NNRecord of the search and the distance to the nearest
+        point.
+        """
+        valid_engines = ['bbox', 'recursive']
+        if engine not in valid_engines:
+            raise ValueError(f"Error: engine must be in ({valid_engines})")
+        if self.sidx_method == 'vptree':
+            result = SpatialUtils()._find_nearest_neighbor_vptree(
+                self.sidx, query_point, self.metric)
+            distance = result.distance
+        else:
+            if engine == 'bbox':
+                result = SpatialUtils()._find_nearest_neighbor_kdtree_bbox(
+                    self.sidx, query_point)
+            else:
+                result = SpatialUtils()._find_nearest_neighbor_kdtree(
+                    self.sidx, query_point)
+            # The k-d tree searches work on squared distances
+            distance = math.sqrt(result.distance)
+        self.last_distance_evaluations = result.evaluations
+        return result, distance
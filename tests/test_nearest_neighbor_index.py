@@ -1,11 +1,14 @@
+import math
 import random
 import time
 import unittest
+import numpy as np
 import pandas as pd
 import os
 from pathlib import Path
 
 from pynn import NearestNeighbor, SpatialUtils
+from pynn.nearest_neighbor_index import DEFAULT_LEAF_SIZE
 
 # Generally you want unit tests that are self contained but in the name of
 # Expediency for this example, I am accesing the example_data CSV's.
@@ -34,6 +37,349 @@ class NearestNeighborTest(unittest.TestCase):
         self.assertEqual((-1000, 20), uut.search_index((-2000, 0)))
         self.assertEqual((42, 3.14159), uut.search_index((40, 3)))
 
+    def test_search_index_outputs(self):
+        """
+        This test checks that search_index can return the row id and distance
+        or the payload of the nearest neighbor, including for duplicate
+        coordinates.
+        """
+        test_points = [(1, 2), (1, 0), (10, 5), (1, 0)]
+        uut = NearestNeighbor(
+            test_points,
+            ids=['a', 'b', 'c', 'd'],
+            payload={'name': ['one', 'two', 'three', 'four']},
+        ).build_index()
+
+        self.assertEqual(('c', 5.0), uut.search_index((10, 0), output='index'))
+        self.assertEqual({'name': 'three'}, uut.search_index((10, 0), output='payload'))
+        # Duplicate coordinates map back to one of their own rows
+        row_id, distance = uut.search_index((1, -1), output='index')
+        self.assertIn(row_id, ('b', 'd'))
+        self.assertEqual(1.0, distance)
+        with self.assertRaises(ValueError):
+            uut.search_index((0, 0), output='bogus')
+        with self.assertRaises(ValueError):
+            NearestNeighbor(test_points, ids=['a'])
+
+    def test_collapse_duplicates(self):
+        """
+        This test checks that collapsing duplicates shrinks the index while
+        searches can still expand every duplicate of the nearest point.
+        """
+        test_points = [(0, 0)] * 50 + [(5, 5), (10, 10), (5, 5)]
+        payload = {'row': list(range(len(test_points)))}
+        full = NearestNeighbor(test_points, payload=payload).build_index(leaf_size=1)
+        collapsed = NearestNeighbor(test_points, payload=payload).build_index(
+            collapse_duplicates=True, leaf_size=1)
+
+        self.assertEqual({'nodes': 3, 'leaves': 0, 'points': 53, 'depth': 2},
+                         collapsed.index_stats())
+        self.assertEqual(53, full.index_stats()['nodes'])
+        self.assertGreater(full.index_stats()['depth'], collapsed.index_stats()['depth'])
+
+        self.assertEqual((5, 5), collapsed.search_index((6, 6)))
+        self.assertEqual((50, math.sqrt(2)), collapsed.search_index((6, 6), output='index'))
+        self.assertEqual(([50, 52], math.sqrt(2)),
+                         collapsed.search_index((6, 6), output='index',
+                                                expand_duplicates=True))
+        self.assertEqual(list(range(50)),
+                         collapsed.search_index((1, 0), output='index',
+                                                expand_duplicates=True)[0])
+        self.assertEqual([{'row': 50}, {'row': 52}],
+                         collapsed.search_index((6, 6), output='payload',
+                                                expand_duplicates=True))
+
+    def test_search_engines(self):
+        """
+        This test checks that the bounding box search engine returns the same
+        neighbors as the recursive engine on clustered data, while computing
+        fewer point distances.
+        """
+        random.seed(0)
+        centers = [(random.uniform(-1000, 1000), random.uniform(-1000, 1000))
+                   for _ in range(10)]
+        def clustered_point():
+            x, y = random.choice(centers)
+            return (random.gauss(x, 5), random.gauss(y, 5))
+
+        index_points = [clustered_point() for _ in range(2000)]
+        query_points = [clustered_point() for _ in range(200)]
+        uut = NearestNeighbor(index_points).build_index()
+
+        recursive_evaluations = 0
+        bbox_evaluations = 0
+        for query_point in query_points:
+            expected = uut.search_index(query_point, output='index', engine='recursive')
+            recursive_evaluations += uut.last_distance_evaluations
+            actual = uut.search_index(query_point, output='index', engine='bbox')
+            bbox_evaluations += uut.last_distance_evaluations
+            self.assertEqual(expected, actual)
+        print(f"Distance evaluations recursive: {recursive_evaluations} | "
+              f"bbox: {bbox_evaluations}")
+        self.assertLess(bbox_evaluations, recursive_evaluations)
+        with self.assertRaises(ValueError):
+            uut.search_index((0, 0), engine='bogus')
+
+    def test_leaf_buckets(self):
+        """
+        This test checks that leaf buckets, with or without collapsed
+        duplicates, return the same neighbors as a tree of single-point nodes.
+        """
+        random.seed(1)
+        index_points = [(random.randint(0, 50), random.randint(0, 50)) for _ in range(3000)]
+        query_points = [(random.uniform(0, 50), random.uniform(0, 50)) for _ in range(200)]
+        baseline = NearestNeighbor(index_points).build_index(leaf_size=1)
+        bucketed = NearestNeighbor(index_points).build_index(leaf_size=64)
+        collapsed = NearestNeighbor(index_points).build_index(
+            leaf_size=64, collapse_duplicates=True)
+
+        self.assertEqual(3000, bucketed.index_stats()['points'])
+        self.assertEqual(3000, collapsed.index_stats()['points'])
+        self.assertGreater(bucketed.index_stats()['leaves'], 0)
+        for query_point in query_points:
+            _, expected = baseline.search_index(query_point, output='index')
+            for uut in (bucketed, collapsed):
+                for engine in ('bbox', 'recursive'):
+                    _, actual = uut.search_index(query_point, output='index', engine=engine)
+                    self.assertEqual(expected, actual)
+            # Expanded duplicates hold every row at the nearest coordinates
+            row_ids, _ = collapsed.search_index(query_point, output='index',
+                                                expand_duplicates=True)
+            nearest = collapsed.search_index(query_point)
+            self.assertEqual([i for i, point in enumerate(index_points) if point == nearest],
+                             sorted(row_ids))
+        with self.assertRaises(ValueError):
+            NearestNeighbor(index_points).build_index(leaf_size=0)
+
+    def test_vptree_custom_metric(self):
+        """
+        This test checks that the vp-tree index returns the nearest neighbor
+        under a user-supplied metric, matching a brute force scan with that
+        metric while evaluating it far fewer times.
+        """
+        def weighted_manhattan(point1, point2):
+            return 3 * abs(point1[0] - point2[0]) + abs(point1[1] - point2[1])
+
+        random.seed(2)
+        index_points = [(random.uniform(-1000, 1000), random.uniform(-1000, 1000))
+                        for _ in range(2000)]
+        query_points = [(random.uniform(-1000, 1000), random.uniform(-1000, 1000))
+                        for _ in range(100)]
+        uut = NearestNeighbor(index_points).build_index(
+            method='vptree', metric=weighted_manhattan)
+
+        evaluations = 0
+        for query_point in query_points:
+            expected = min(range(len(index_points)),
+                           key=lambda i: weighted_manhattan(query_point, index_points[i]))
+            row_id, distance = uut.search_index(query_point, output='index')
+            evaluations += uut.last_distance_evaluations
+            self.assertEqual(expected, row_id)
+            self.assertEqual(weighted_manhattan(query_point, index_points[expected]), distance)
+        print(f"VP-tree distance evaluations per query: {evaluations / len(query_points):0.1f}")
+        self.assertLess(evaluations, len(query_points) * len(index_points) / 10)
+
+        # The default metric is Euclidean, matching the k-d tree
+        vptree = NearestNeighbor(index_points).build_index(method='vptree')
+        kdtree = NearestNeighbor(index_points).build_index()
+        for query_point in query_points:
+            self.assertEqual(kdtree.search_index(query_point), vptree.search_index(query_point))
+        with self.assertRaises(ValueError):
+            NearestNeighbor(index_points).build_index(metric=weighted_manhattan)
+
+        # A rejected or failed rebuild keeps the previous index usable, and
+        # leaf_size is not checked by the vp-tree method, which does not use it
+        def broken_metric(point1, point2):
+            raise ValueError("Error: broken metric")
+
+        with self.assertRaises(ValueError):
+            kdtree.build_index(method='bogus')
+        with self.assertRaises(ValueError):
+            kdtree.build_index(method='vptree', metric=broken_metric)
+        self.assertEqual('kdtree', kdtree.sidx_method)
+        self.assertEqual(index_points[0], kdtree.search_index(index_points[0]))
+        vptree.build_index(method='vptree', leaf_size=0)
+        self.assertEqual(index_points[0], vptree.search_index(index_points[0]))
+
+    def test_non_finite_points_rejected(self):
+        """
+        This test checks that the k-d tree refuses NaN or infinite points,
+        which would otherwise hide their whole leaf bucket from searches.
+        """
+        random.seed(3)
+        index_points = [(random.uniform(0, 100), random.uniform(0, 100)) for _ in range(2000)]
+        for bad_point in ((math.nan, 5.0), (5.0, math.inf)):
+            for leaf_size in (1, DEFAULT_LEAF_SIZE):
+                uut = NearestNeighbor(index_points + [bad_point])
+                with self.assertRaises(ValueError):
+                    uut.build_index(leaf_size=leaf_size)
+
+    def test_leaf_size_benchmark(self):
+        """
+        This test times the bbox search across leaf sizes, picks the fastest
+        one, and asserts that DEFAULT_LEAF_SIZE is within a tolerance of it.
+        It also asserts that every leaf size returns the same nearest
+        neighbors.
+
+        The search is timed directly, without the input validation of
+        search_index, so that the timings reflect the tree layout.
+        """
+        def rand_point(): return (random.uniform(-1000, 1000), random.uniform(-1000, 1000))
+
+        index_points = [rand_point() for _ in range(10000)]
+        query_points = [rand_point() for _ in range(1000)]
+        columns = tuple(np.array(index_points).T)
+
+        leaf_sizes = sorted({1, 8, 16, 32, 64, 128, 256, 512, DEFAULT_LEAF_SIZE})
+        trees = {leaf_size: SpatialUtils._build_kdtree(columns, leaf_size=leaf_size)
+                 for leaf_size in leaf_sizes}
+        timings = dict.fromkeys(leaf_sizes, math.inf)
+        results = {}
+        # Keep the best of several interleaved runs to smooth out timing noise
+        for _ in range(5):
+            for leaf_size, tree in trees.items():
+                start = time.perf_counter()
+                results[leaf_size] = [
+                    int(SpatialUtils._find_nearest_neighbor_kdtree_bbox(
+                        tree, query_point).indices[0])
+                    for query_point in query_points]
+                timings[leaf_size] = min(timings[leaf_size], time.perf_counter() - start)
+        for leaf_size in leaf_sizes:
+            print(f"Leaf size {leaf_size}: {timings[leaf_size]:0.3f}sec")
+        fastest = min(timings, key=timings.get)
+        print(f"Picked leaf size: {fastest} (default: {DEFAULT_LEAF_SIZE})")
+
+        self.assertLessEqual(timings[DEFAULT_LEAF_SIZE], 1.5 * timings[fastest])
+        for leaf_size in leaf_sizes:
+            self.assertEqual(results[1], results[leaf_size])
+
+    def test_frame_join(self):
+        """
+        This test checks that an index built from DataFrame columns shares
+        their buffers, and that query_frame returns the same neighbors as
+        search_index as typed columns.
+        """
+        user000 = pd.read_csv(os.path.join(this_dir.parent, 'example_data/data_000_track.csv'))
+        user010 = pd.read_csv(os.path.join(this_dir.parent, 'example_data/data_010_track.csv'))
+        user010.index = user010.index + 1000
+
+        uut = NearestNeighbor.from_frame(
+            user010, x='longitude', y='latitude', payload=['altitude']).build_index()
+        self.assertTrue(np.shares_memory(uut.columns[0], user010.longitude.to_numpy()))
+        # Frame-built objects carry the same attributes as constructed ones
+        constructed = NearestNeighbor(list(zip(user010.longitude, user010.latitude)),
+                                      payload={'altitude': user010.altitude}).build_index()
+        self.assertEqual(sorted(vars(constructed)), sorted(vars(uut)))
+
+        result = uut.query_frame(user000, x='longitude', y='latitude')
+        self.assertEqual(['neighbor_id', 'neighbor_x', 'neighbor_y',
+                          'neighbor_distance', 'neighbor_altitude'], list(result.columns))
+        self.assertTrue(result.index.equals(user000.index))
+        self.assertEqual(np.int64, result.neighbor_id.dtype)
+        self.assertEqual(np.float64, result.neighbor_distance.dtype)
+        for row, point in enumerate(zip(user000.longitude, user000.latitude)):
+            row_id, distance = uut.search_index(point, output='index')
+            self.assertEqual(row_id, result.neighbor_id.iloc[row])
+            self.assertEqual(distance, result.neighbor_distance.iloc[row])
+            self.assertEqual(user010.altitude[row_id], result.neighbor_altitude.iloc[row])
+            self.assertEqual((user010.longitude[row_id], user010.latitude[row_id]),
+                             (result.neighbor_x.iloc[row], result.neighbor_y.iloc[row]))
+
+        # Query columns named differently from the indexed columns give the
+        # same result columns
+        renamed = user000.rename(columns={'longitude': 'lon', 'latitude': 'lat'})
+        pd.testing.assert_frame_equal(result, uut.query_frame(renamed, x='lon', y='lat'))
+
+    def test_query_frame_batch(self):
+        """
+        This test checks the whole-frame nearest neighbor join against a brute
+        force distance matrix, for every index layout.
+        """
+        random.seed(4)
+        index_frame = pd.DataFrame({
+            'x': [float(random.randint(0, 100)) for _ in range(3000)],
+            'y': [float(random.randint(0, 100)) for _ in range(3000)],
+        })
+        query_frame = pd.DataFrame({
+            'x': [random.uniform(-10, 110) for _ in range(500)],
+            'y': [random.uniform(-10, 110) for _ in range(500)],
+        })
+        deltas = (query_frame.to_numpy()[:, np.newaxis, :]
+                  - index_frame.to_numpy()[np.newaxis, :, :])
+        expected = np.sqrt((deltas * deltas).sum(axis=2))
+
+        for options in ({'leaf_size': 1}, {}, {'collapse_duplicates': True},
+                        {'method': 'vptree'}):
+            uut = NearestNeighbor.from_frame(index_frame, x='x', y='y').build_index(**options)
+            result = uut.query_frame(query_frame, x='x', y='y')
+            np.testing.assert_allclose(expected.min(axis=1), result.neighbor_distance)
+            np.testing.assert_allclose(
+                expected.min(axis=1),
+                expected[np.arange(len(query_frame)), result.neighbor_id.to_numpy()])
+            self.assertGreater(uut.last_distance_evaluations, 0)
+
+    def test_object_ids_and_payload(self):
+        """
+        This test checks that tuple and string ids and payload values are
+        returned unchanged by search_index and query_frame, for every index
+        method.
+        """
+        points = [(0.0, 0.0), (5.0, 5.0), (10.0, 0.0)]
+        ids = [('a', 1), ('b', 2), ('c', 3)]
+        payload = {'pair': [(1, 2), (3, 4), (5, 6)], 'name': ['one', 'two', 'three'],
+                   'count': [10, 20, 30]}
+        queries = pd.DataFrame({'x': [9.0, 1.0], 'y': [1.0, 0.0]}, index=['q1', 'q2'])
+
+        for method in ('kdtree', 'vptree'):
+            uut = NearestNeighbor(points, ids=ids, payload=payload).build_index(method=method)
+            self.assertEqual(('c', 3), uut.search_index((9, 1), output='index')[0])
+            self.assertEqual({'pair': (5, 6), 'name': 'three', 'count': 30},
+                             uut.search_index((9, 1), output='payload'))
+
+            result = uut.query_frame(queries, x='x', y='y')
+            self.assertEqual([('c', 3), ('a', 1)], result.neighbor_id.tolist())
+            self.assertEqual([(5, 6), (1, 2)], result.neighbor_pair.tolist())
+            self.assertEqual(['three', 'one'], result.neighbor_name.tolist())
+            # Strings are not truncated to a fixed-width NumPy dtype
+            self.assertNotEqual('U', result.neighbor_name.dtype.kind)
+            self.assertEqual(np.int64, result.neighbor_count.dtype)
+
+    def test_query_frame_column_clash(self):
+        """
+        This test checks that query_frame refuses payload columns whose result
+        names would overwrite the neighbor id, coordinate or distance columns.
+        """
+        frame = pd.DataFrame({'x': [0.0, 5.0], 'y': [0.0, 5.0],
+                              'distance': [7.0, 8.0], 'id': [1, 2]})
+        for payload in (['distance'], ['id'], ['x']):
+            uut = NearestNeighbor.from_frame(frame, x='x', y='y', payload=payload).build_index()
+            with self.assertRaisesRegex(ValueError, "clash"):
+                uut.query_frame(frame, x='x', y='y')
+            # The payload is still available through search_index
+            self.assertEqual({payload[0]: frame[payload[0]][0]},
+                             uut.search_index((0.0, 0.0), output='payload'))
+
+    def test_frame_missing_coordinates(self):
+        """
+        This test checks that missing coordinates in the indexed or the query
+        DataFrame raise a ValueError instead of failing inside the search.
+        """
+        user000 = pd.read_csv(os.path.join(this_dir.parent, 'example_data/data_000_track.csv'))
+        user010 = pd.read_csv(os.path.join(this_dir.parent, 'example_data/data_010_track.csv'))
+
+        missing = user010.copy()
+        missing.loc[10, 'latitude'] = np.nan
+        with self.assertRaisesRegex(ValueError, "latitude"):
+            NearestNeighbor.from_frame(missing, x='longitude', y='latitude')
+
+        uut = NearestNeighbor.from_frame(user010, x='longitude', y='latitude').build_index()
+        missing = user000.copy()
+        missing.loc[3, 'longitude'] = np.nan
+        with self.assertRaisesRegex(ValueError, "longitude"):
+            uut.query_frame(missing, x='longitude', y='latitude')
+        with self.assertRaises(ValueError):
+            uut.search_index((math.nan, 40.0))
+
     def test_speed_benchmark(self):
         """
         This test demonstrates the optimization of the spatial index, and
@@ -82,18 +428,18 @@ class NearestNeighborTest(unittest.TestCase):
         """
         # Read in the spatial example data
         user000 = pd.read_csv(os.path.join(this_dir.parent, 'example_data/data_000_track.csv'))
-        user179 = pd.read_csv(os.path.join(this_dir.parent, 'example_data/data_179_track.csv'))
+        user010 = pd.read_csv(os.path.join(this_dir.parent, 'example_data/data_010_track.csv'))
         # Lists for storing expected and actual NN results
         expected = []
         actual = []
         # Build the index
         user000_points = list(zip(user000.longitude, user000.latitude))
-        user179_points = list(zip(user179.longitude, user179.latitude))
-        sidx = NearestNeighbor(user179_points).build_index()
+        user010_points = list(zip(user010.longitude, user010.latitude))
+        sidx = NearestNeighbor(user010_points).build_index()
         # Generate the brute force results
         start = time.time()
         for point in user000_points:
-            expected.append(SpatialUtils().find_nearest_naive(point, user179_points))
+            expected.append(SpatialUtils().find_nearest_naive(point, user010_points))
         end = time.time()
         brute_time = end-start
         print(f"Trajectory example brute force time: {brute_time:0.2f}sec")